@@ -7,9 +7,13 @@ License : MIT
 # IMPORTS
 import os
 import sys
+import mmap
+import stat
 import struct
+import tempfile
+import time
 import multiprocessing
-from typing import List, Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple, Iterable, Dict
 from concurrent.futures import ProcessPoolExecutor
 import array
 
@@ -403,5 +407,634 @@ def easyhash_hex(data: Union[bytes, str], parallel: bool = True) -> str:
     return EasyHash(data, parallel=parallel).hexdigest()
 
 
+def easyhash_file(path: str, parallel: bool = True) -> bytes:
+    """Convenience function to hash a file without loading it whole"""
+    hasher = EasyHash(parallel=parallel)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+def _copy_target_mode(tmp_path: str, target: str) -> None:
+    """
+    Give a mkstemp() file (always 0600) the mode of the file it replaces,
+    or the umask default when the target does not exist yet
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmp_path, mode)
+
+
+class MerkleIndex:
+    """
+    Merkle tree of EasyHash leaf digests over a file, stored in a sidecar index
+
+    The file is split into fixed-size leaves, so after a partial write only the
+    affected leaves and their ancestors have to be re-hashed, and any byte range
+    can be verified against the root on its own.
+    """
+
+    # Class constants
+    DEFAULT_LEAF_SIZE: int = 1024 * 1024  # 1MB leaves
+    SIDECAR_SUFFIX: str = ".ehidx"
+
+    # Sidecar layout: magic, version, leaf size, file size, mtime (ns), leaf count
+    __MAGIC: bytes = b"EHMI"
+    __VERSION: int = 1
+    __HEADER = struct.Struct("<4sB3xQQqQ")
+
+    # Domain separation so a leaf digest can never be taken for a node digest
+    __LEAF_PREFIX: bytes = b"\x00"
+    __NODE_PREFIX: bytes = b"\x01"
+
+    def __init__(self, path: str, leaf_size: int = None) -> None:
+        """
+        Create an empty index for a file, call update() to hash it
+
+        Args:
+            path: File covered by the index
+            leaf_size: Size of each leaf in bytes (multiple of EasyHash.block_size)
+        """
+        leaf_size = leaf_size or self.DEFAULT_LEAF_SIZE
+        if leaf_size <= 0 or leaf_size % EasyHash.block_size:
+            raise ValueError(f"leaf_size must be a positive multiple of {EasyHash.block_size}")
+
+        self.__path = path
+        self.__leaf_size = leaf_size
+        self.__file_size = 0
+        self.__mtime_ns = 0
+
+        # Tree levels from the leaves up to the root, digests packed back to back
+        self.__levels: List[bytearray] = []
+
+    @classmethod
+    def build(cls, path: str, leaf_size: int = None):
+        """Hash a whole file and return its index"""
+        index = cls(path, leaf_size)
+        index.update()
+        return index
+
+    @classmethod
+    def load(cls, path: str, index_path: str = None):
+        """Load the sidecar index of a file"""
+        index_path = index_path or path + cls.SIDECAR_SUFFIX
+        with open(index_path, "rb") as f:
+            header = f.read(cls.__HEADER.size)
+            payload = f.read()
+
+        if len(header) != cls.__HEADER.size:
+            raise ValueError(f"Truncated index file: {index_path}")
+        magic, version, leaf_size, file_size, mtime_ns, leaf_count = cls.__HEADER.unpack(header)
+        if magic != cls.__MAGIC or version != cls.__VERSION:
+            raise ValueError(f"Not an EasyHash index file: {index_path}")
+
+        index = cls(path, leaf_size)
+        index.__file_size = file_size
+        index.__mtime_ns = mtime_ns
+        if leaf_count != index.__leaf_count_for(file_size):
+            raise ValueError(f"Corrupted index file: {index_path}")
+
+        # Level sizes follow from the leaf count alone
+        ds = EasyHash.digest_size
+        offset = 0
+        count = leaf_count
+        while True:
+            index.__levels.append(bytearray(payload[offset:offset + count * ds]))
+            offset += count * ds
+            if count <= 1:
+                break
+            count = (count + 1) // 2
+
+        if offset != len(payload) or len(index.__levels[-1]) != ds:
+            raise ValueError(f"Corrupted index file: {index_path}")
+        return index
+
+    def save(self, index_path: str = None) -> None:
+        """Write the index next to the file (or to index_path)"""
+        index_path = index_path or self.__path + self.SIDECAR_SUFFIX
+        header = self.__HEADER.pack(self.__MAGIC, self.__VERSION, self.__leaf_size,
+                                    self.__file_size, self.__mtime_ns, self.leaf_count)
+
+        # Write to a unique temporary file first so a crash or a concurrent
+        # save never leaves a torn index
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for level in self.__levels:
+                    f.write(level)
+            _copy_target_mode(tmp_path, index_path)
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def leaf_size(self) -> int:
+        return self.__leaf_size
+
+    @property
+    def leaf_count(self) -> int:
+        return len(self.__levels[0]) // EasyHash.digest_size if self.__levels else 0
+
+    @property
+    def root(self) -> bytes:
+        """Merkle root of the file"""
+        if not self.__levels:
+            raise ValueError("Index is empty, call update() first")
+        return bytes(self.__levels[-1])
+
+    @property
+    def root_hex(self) -> str:
+        return self.root.hex()
+
+    def leaf_digest(self, leaf_index: int) -> bytes:
+        """Return the stored digest of a leaf"""
+        return self.__node(0, leaf_index)
+
+    def is_stale(self) -> bool:
+        """Check whether the file size or mtime differ from the indexed ones"""
+        st = os.stat(self.__path)
+        return not self.__levels or (st.st_size, st.st_mtime_ns) != (self.__file_size, self.__mtime_ns)
+
+    def update(self, ranges: Optional[Iterable[Tuple[int, int]]] = None) -> List[int]:
+        """
+        Re-hash the file and return the indices of the leaves that changed
+
+        Args:
+            ranges: Changed (offset, length) byte ranges, only the leaves they
+                touch are read. When omitted, every leaf is re-hashed if the
+                file size or mtime changed, otherwise nothing is read.
+        """
+        st = os.stat(self.__path)
+        old_count = self.leaf_count
+        new_count = self.__leaf_count_for(st.st_size)
+
+        if not self.__levels:
+            candidates = set(range(new_count))
+        elif ranges is None:
+            if not self.is_stale():
+                return []
+            candidates = set(range(new_count))
+        else:
+            candidates = set()
+            for offset, length in ranges:
+                if offset < 0 or length < 0:
+                    raise ValueError(f"Invalid range: ({offset}, {length})")
+                if length == 0 or offset >= st.st_size:
+                    continue
+                first = offset // self.__leaf_size
+                last = min(offset + length - 1, st.st_size - 1) // self.__leaf_size
+                candidates.update(range(first, last + 1))
+
+            # A resized file also changes the leaves around the old and new end
+            if st.st_size != self.__file_size:
+                first = min(min(self.__file_size, st.st_size) // self.__leaf_size, new_count - 1)
+                candidates.update(range(first, new_count))
+
+        # Resize the leaf level, new leaves are filled in below
+        ds = EasyHash.digest_size
+        if not self.__levels:
+            self.__levels.append(bytearray())
+        leaves = self.__levels[0]
+        del leaves[new_count * ds:]
+        if new_count > old_count:
+            leaves.extend(bytes((new_count - old_count) * ds))
+
+        changed = []
+        with open(self.__path, "rb") as f:
+            for i in sorted(candidates):
+                f.seek(i * self.__leaf_size)
+                digest = self.__hash_leaf(f.read(self.__leaf_size))
+                if i >= old_count or leaves[i * ds:(i + 1) * ds] != digest:
+                    leaves[i * ds:(i + 1) * ds] = digest
+                    changed.append(i)
+
+        self.__propagate(changed, old_count)
+        self.__file_size = st.st_size
+        self.__mtime_ns = st.st_mtime_ns
+        return changed
+
+    def proof(self, leaf_index: int) -> List[Tuple[bool, bytes]]:
+        """
+        Return the authentication path of a leaf as (sibling_is_left, digest)
+        pairs, from the leaf level up to the root
+        """
+        if not 0 <= leaf_index < self.leaf_count:
+            raise IndexError(f"Leaf index out of range: {leaf_index}")
+
+        path = []
+        index = leaf_index
+        for level in range(len(self.__levels) - 1):
+            sibling = index ^ 1
+            if sibling < len(self.__levels[level]) // EasyHash.digest_size:
+                path.append((sibling < index, self.__node(level, sibling)))
+            index >>= 1
+        return path
+
+    @classmethod
+    def verify_proof(cls, leaf_digest: bytes, proof: List[Tuple[bool, bytes]], root: bytes) -> bool:
+        """Check that a leaf digest and its authentication path lead to root"""
+        digest = leaf_digest
+        for sibling_is_left, sibling in proof:
+            if sibling_is_left:
+                digest = cls.__hash_node(sibling, digest)
+            else:
+                digest = cls.__hash_node(digest, sibling)
+        return digest == root
+
+    def verify_range(self, offset: int, length: int) -> bool:
+        """
+        Verify a byte range of the file against the Merkle root,
+        only the leaves covering the range are read
+        """
+        if offset < 0 or length <= 0 or offset + length > self.__file_size:
+            raise ValueError(f"Range ({offset}, {length}) is outside the indexed file")
+
+        root = self.root
+        first = offset // self.__leaf_size
+        last = (offset + length - 1) // self.__leaf_size
+        with open(self.__path, "rb") as f:
+            for i in range(first, last + 1):
+                f.seek(i * self.__leaf_size)
+                digest = self.__hash_leaf(f.read(self.__leaf_size))
+                if digest != self.leaf_digest(i) or not self.verify_proof(digest, self.proof(i), root):
+                    return False
+        return True
+
+    def __leaf_count_for(self, size: int) -> int:
+        """An empty file still has a single (empty) leaf"""
+        return max(1, -(-size // self.__leaf_size))
+
+    def __node(self, level: int, index: int) -> bytes:
+        ds = EasyHash.digest_size
+        return bytes(self.__levels[level][index * ds:(index + 1) * ds])
+
+    def __propagate(self, dirty: List[int], old_count: int) -> None:
+        """Recompute the ancestors of the dirty nodes, level by level"""
+        ds = EasyHash.digest_size
+        level = 0
+        dirty = set(dirty)
+
+        while len(self.__levels[level]) > ds:
+            child_count = len(self.__levels[level]) // ds
+            parent_count = (child_count + 1) // 2
+            if level + 1 == len(self.__levels):
+                self.__levels.append(bytearray())
+            parent = self.__levels[level + 1]
+            old_parent_count = len(parent) // ds
+
+            parents = {i >> 1 for i in dirty}
+            if child_count != old_count:
+                # The last node may have gained or lost its sibling
+                parents.add((child_count - 1) >> 1)
+
+            del parent[parent_count * ds:]
+            if parent_count > old_parent_count:
+                parent.extend(bytes((parent_count - old_parent_count) * ds))
+
+            for j in parents:
+                left = self.__node(level, 2 * j)
+                if 2 * j + 1 < child_count:
+                    digest = self.__hash_node(left, self.__node(level, 2 * j + 1))
+                else:
+                    digest = left  # Odd node is carried up unchanged
+                parent[j * ds:(j + 1) * ds] = digest
+
+            dirty = parents
+            old_count = old_parent_count
+            level += 1
+
+        # Drop levels left over from a larger tree
+        del self.__levels[level + 1:]
+
+    @classmethod
+    def __hash_leaf(cls, data: bytes) -> bytes:
+        hasher = EasyHash(cls.__LEAF_PREFIX, parallel=False)
+        hasher.update(data)
+        return hasher.digest()
+
+    @classmethod
+    def __hash_node(cls, left: bytes, right: bytes) -> bytes:
+        return EasyHash(cls.__NODE_PREFIX + left + right, parallel=False).digest()
+
+
+# (device, inode, size, mtime_ns) of a file, used to skip unchanged files
+StatKey = Tuple[int, int, int, int]
+
+# Files modified this close to the start of a run are not cached, a same-size
+# rewrite within one timestamp tick would otherwise keep the same key
+_RACY_MARGIN_NS = 2 * 1000 * 1000 * 1000  # 2s, the coarsest common granularity (FAT)
+
+# Same threshold as EasyHash, below it spawning workers costs more than it saves
+_TREE_MIN_SIZE_FOR_MP = 16 * 1024 * 1024  # 16MB of files to hash
+
+
+def _stat_key(st: os.stat_result) -> StatKey:
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _hash_file_worker(path: str) -> Tuple[bytes, StatKey]:
+    """Hash a file in a worker process, return its digest and stat key afterwards"""
+    digest = easyhash_file(path, parallel=False)
+    return digest, _stat_key(os.stat(path))
+
+
+class DigestCache:
+    """
+    On-disk cache of file digests keyed by (device, inode, size, mtime_ns)
+
+    Records are kept sorted in a flat file and looked up by binary search over
+    a memory map, so nothing is parsed up front however large the cache is.
+    New digests are kept in memory until save() merges them in. A truncated,
+    foreign or older-version file counts as empty and is rewritten on save().
+    """
+
+    # Cache layout: magic, version, record count, then sorted records
+    __MAGIC: bytes = b"EHDC"
+    __VERSION: int = 1
+    __HEADER = struct.Struct("<4sB3xQ")
+    __RECORD = struct.Struct("<QQQq16s")
+    __KEY = struct.Struct("<QQQq")
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path: Cache file, created on save() if it does not exist
+        """
+        self.__path = path
+        self.__file = None
+        self.__map = None
+        self.__count = 0
+        self.__loaded = False
+        self.__stale_file = False  # Existing file is unusable and must be rewritten
+
+        # Pending changes, applied on save()
+        self.__added: Dict[StatKey, bytes] = {}
+        self.__dead = set()  # Record positions superseded by a newer stat
+        self.__live = set()  # Record positions hit since the cache was opened
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __load(self) -> None:
+        """Map the cache file on first use, an unusable file counts as empty"""
+        self.__loaded = True
+        try:
+            self.__file = open(self.__path, "rb")
+        except FileNotFoundError:
+            return
+        except OSError:
+            self.__stale_file = True
+            return
+
+        count = None
+        header = self.__file.read(self.__HEADER.size)
+        if len(header) == self.__HEADER.size:
+            magic, version, count = self.__HEADER.unpack(header)
+            if magic != self.__MAGIC or version != self.__VERSION:
+                count = None
+
+        if count:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.__map) != self.__HEADER.size + count * self.__RECORD.size:
+                count = None
+
+        if count is None:
+            # Truncated, foreign or older cache: it is only a cache, so hash
+            # everything again and let save() rewrite it in the current format
+            self.__release()
+            self.__stale_file = True
+            return
+        self.__count = count
+
+    def __key_at(self, position: int) -> StatKey:
+        return self.__KEY.unpack_from(self.__map, self.__HEADER.size + position * self.__RECORD.size)
+
+    def __records(self) -> Iterable[Tuple[int, StatKey, bytes]]:
+        for position in range(self.__count):
+            *key, digest = self.__RECORD.unpack_from(
+                self.__map, self.__HEADER.size + position * self.__RECORD.size)
+            yield position, tuple(key), digest
+
+    def get(self, key: StatKey) -> Optional[bytes]:
+        """Return the cached digest for a stat key, or None"""
+        if key in self.__added:
+            return self.__added[key]
+        if not self.__loaded:
+            self.__load()
+
+        # Binary search for the first record >= key
+        low, high = 0, self.__count
+        while low < high:
+            mid = (low + high) // 2
+            if self.__key_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+
+        # Records of the same file with another size or mtime sort next to it
+        # and can never match again
+        for position in self.__same_file(low, key):
+            if self.__key_at(position) != key:
+                self.__dead.add(position)
+
+        if low < self.__count and self.__key_at(low) == key:
+            self.__live.add(low)
+            offset = self.__HEADER.size + low * self.__RECORD.size + self.__KEY.size
+            return bytes(self.__map[offset:offset + EasyHash.digest_size])
+        return None
+
+    def __same_file(self, position: int, key: StatKey) -> Iterable[int]:
+        """Positions around position whose (device, inode) match key"""
+        left = position - 1
+        while left >= 0 and self.__key_at(left)[:2] == key[:2]:
+            yield left
+            left -= 1
+        right = position
+        while right < self.__count and self.__key_at(right)[:2] == key[:2]:
+            yield right
+            right += 1
+
+    def put(self, key: StatKey, digest: bytes) -> None:
+        """Store the digest of a file, written out on save()"""
+        self.__added[key] = digest
+
+    def save(self, compact: bool = False) -> None:
+        """
+        Merge pending digests into the cache file
+
+        Args:
+            compact: Also drop every record that was not used since the cache
+                was opened (files that were deleted or are no longer hashed)
+        """
+        if not self.__loaded:
+            self.__load()
+        if not (self.__added or self.__dead or compact or self.__stale_file):
+            return
+
+        records = dict(self.__added)
+        for position, key, digest in self.__records():
+            if position in self.__dead or (compact and position not in self.__live):
+                continue
+            records.setdefault(key, digest)
+
+        # Write to a unique temporary file first so a crash or a concurrent
+        # save never leaves a torn cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.__path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.__HEADER.pack(self.__MAGIC, self.__VERSION, len(records)))
+                for key in sorted(records):
+                    f.write(self.__RECORD.pack(*key, records[key]))
+
+            _copy_target_mode(tmp_path, self.__path)
+            self.close()
+            os.replace(tmp_path, self.__path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def __release(self) -> None:
+        """Unmap and close the cache file"""
+        if self.__map is not None:
+            self.__map.close()
+        if self.__file is not None:
+            self.__file.close()
+        self.__file = None
+        self.__map = None
+        self.__count = 0
+
+    def close(self) -> None:
+        """Release the cache file and forget pending changes"""
+        self.__release()
+        self.__loaded = False
+        self.__stale_file = False
+        self.__added.clear()
+        self.__dead.clear()
+        self.__live.clear()
+
+
+def _raise_walk_error(error: OSError) -> None:
+    """os.walk() error handler, a directory that cannot be listed must not be skipped"""
+    raise error
+
+
+class _NullCache:
+    """Stand-in for DigestCache when no cache file is given"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def get(self, key: StatKey) -> Optional[bytes]:
+        return None
+
+    def put(self, key: StatKey, digest: bytes) -> None:
+        pass
+
+    def save(self, compact: bool = False) -> None:
+        pass
+
+
+def hash_tree(root: str, cache_path: str = None, max_workers: int = None,
+              compact: bool = False, min_size_for_mp: int = None) -> bytes:
+    """
+    Hash a directory tree into a single deterministic digest
+
+    Args:
+        root: Directory to hash
+        cache_path: Digest cache file, unchanged files are not re-hashed
+        max_workers: Maximum number of worker processes
+        compact: Drop cache records of files that are no longer in the tree
+        min_size_for_mp: Minimum total size of files to hash to use multiprocessing
+
+    Raises:
+        OSError: If root is not a directory or part of the tree cannot be read,
+            so the digest never covers only part of the tree
+    """
+    if not stat.S_ISDIR(os.stat(root).st_mode):
+        raise NotADirectoryError(f"Not a directory: {root}")
+
+    # Anything modified after this may still change without changing its key
+    racy_after = time.time_ns() - _RACY_MARGIN_NS
+
+    # Relative path -> (entry kind, payload)
+    entries: Dict[str, Tuple[bytes, bytes]] = {}
+    pending: List[Tuple[str, str, StatKey]] = []
+
+    with DigestCache(cache_path) if cache_path else _NullCache() as cache:
+        for dirpath, dirnames, filenames in os.walk(root, onerror=_raise_walk_error):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(path, root).replace(os.sep, "/")
+                st = os.lstat(path)
+
+                if stat.S_ISLNK(st.st_mode):
+                    # Links are recorded, never followed
+                    entries[rel_path] = (b"l", os.fsencode(os.readlink(path)))
+                elif stat.S_ISDIR(st.st_mode):
+                    entries[rel_path] = (b"d", b"")
+                elif stat.S_ISREG(st.st_mode):
+                    key = _stat_key(st)
+                    digest = cache.get(key)
+                    if digest is None:
+                        pending.append((rel_path, path, key))
+                    else:
+                        entries[rel_path] = (b"f", digest)
+
+        # Hash the files that missed the cache, in parallel when worth it
+        paths = [path for _, path, _ in pending]
+        pending_size = sum(key[2] for _, _, key in pending)
+        if (len(paths) > 1 and max_workers != 1
+                and pending_size >= (min_size_for_mp or _TREE_MIN_SIZE_FOR_MP)):
+            ctx = multiprocessing.get_context('spawn')  # More stable than fork
+            workers = min(len(paths), max_workers or os.cpu_count() or 4)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                # One task per file, largest first, so big files spread over
+                # all workers and small ones fill the gaps at the end
+                order = sorted(range(len(paths)), key=lambda i: pending[i][2][2], reverse=True)
+                futures = {i: pool.submit(_hash_file_worker, paths[i]) for i in order}
+                results = [futures[i].result() for i in range(len(paths))]
+        else:
+            results = [_hash_file_worker(path) for path in paths]
+
+        for (rel_path, _, key), (digest, key_after) in zip(pending, results):
+            entries[rel_path] = (b"f", digest)
+            # Only cache files that were not modified while being hashed and
+            # whose mtime is old enough to change on the next write
+            if key_after == key and key[3] < racy_after:
+                cache.put(key, digest)
+
+        cache.save(compact=compact)
+
+    # Combine the entries in path order so the walk order does not matter
+    hasher = EasyHash(parallel=False)
+    for rel_path in sorted(entries):
+        kind, payload = entries[rel_path]
+        hasher.update(kind + os.fsencode(rel_path) + b"\x00" + struct.pack("<I", len(payload)) + payload)
+    return hasher.digest()
+
+
+def hash_tree_hex(root: str, cache_path: str = None, max_workers: int = None,
+                  compact: bool = False, min_size_for_mp: int = None) -> str:
+    """Convenience function to get the tree digest as hexadecimal"""
+    return hash_tree(root, cache_path, max_workers, compact, min_size_for_mp).hex()
+
+
 if __name__ == "__main__":
     sys.exit()
@@ -10,6 +10,8 @@ license : MIT
      - Avalanche effect
      - collisions
      - performance tests
+     - merkle index
+     - tree hashing
 """
 
 # IMPORTS
@@ -19,7 +21,8 @@ import random
 import hashlib
 import string
 import pickle
-from test import EasyHash, easyhash, easyhash_hex
+import tempfile
+from easyhash import EasyHash, easyhash, easyhash_hex, MerkleIndex, hash_tree
 
 
 
@@ -249,6 +252,141 @@ def test_scalability():
         print("✅ Hash function appears to scale linearly with input size")
 
 
+def test_merkle_index():
+    """Test that incremental Merkle index updates match a full re-hash"""
+    print("\n=== Testing Merkle Index ===")
+
+    leaf_size = 4096
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "image.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(leaf_size * 10 + 123))
+
+        index = MerkleIndex.build(path, leaf_size)
+        index.save()
+
+        # Overwrite a few bytes in the middle of the file
+        with open(path, "r+b") as f:
+            f.seek(leaf_size * 4 + 10)
+            f.write(b"changed")
+
+        if not index.verify_range(leaf_size * 4, 100) and index.verify_range(0, leaf_size):
+            print("✅ Range verification: Passed")
+        else:
+            print("❌ Range verification: Failed")
+
+        # Only the touched leaf should be re-hashed
+        index = MerkleIndex.load(path)
+        changed = index.update([(leaf_size * 4 + 10, 7)])
+        full = MerkleIndex.build(path, leaf_size)
+
+        if changed == [4] and index.root == full.root:
+            print("✅ Incremental re-hash: Passed")
+        else:
+            print("❌ Incremental re-hash: Failed")
+
+        # Grow the file and check the tree is rebuilt correctly
+        with open(path, "ab") as f:
+            f.write(os.urandom(leaf_size * 3))
+        index.update([])
+
+        if index.root == MerkleIndex.build(path, leaf_size).root:
+            print("✅ Resized file: Passed")
+        else:
+            print("❌ Resized file: Failed")
+
+
+def test_tree_hashing():
+    """Test tree digests and the stat-keyed digest cache"""
+    print("\n=== Testing Tree Hashing ===")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "tree")
+        cache_path = os.path.join(tmp_dir, "digests.cache")
+        os.makedirs(os.path.join(root, "sub"))
+        for i in range(20):
+            path = os.path.join(root, "sub" if i % 2 else "", f"file_{i}.txt")
+            with open(path, "wb") as f:
+                f.write(os.urandom(random.randint(0, 4096)))
+
+            # Files modified just now are never cached, age them
+            old_time = time.time() - 3600
+            os.utime(path, (old_time, old_time))
+
+        # First run fills the cache, second run is served from it
+        plain = hash_tree(root)
+        cold = hash_tree(root, cache_path)
+        warm = hash_tree(root, cache_path)
+
+        if plain == cold == warm:
+            print("✅ Cached tree digest: Passed")
+        else:
+            print("❌ Cached tree digest: Failed")
+
+        # Force the worker pool even for this small tree
+        if hash_tree(root, min_size_for_mp=1) == plain:
+            print("✅ Parallel tree digest: Passed")
+        else:
+            print("❌ Parallel tree digest: Failed")
+
+        # A modified file must be picked up despite the cache
+        with open(os.path.join(root, "sub", "file_1.txt"), "ab") as f:
+            f.write(b"changed")
+
+        if hash_tree(root, cache_path) == hash_tree(root) != warm:
+            print("✅ Cache invalidation: Passed")
+        else:
+            print("❌ Cache invalidation: Failed")
+
+        # Compaction drops the records of deleted files
+        size_before = os.path.getsize(cache_path)
+        os.remove(os.path.join(root, "file_0.txt"))
+        hash_tree(root, cache_path, compact=True)
+
+        if os.path.getsize(cache_path) < size_before:
+            print("✅ Cache compaction: Passed")
+        else:
+            print("❌ Cache compaction: Failed")
+
+        # A same-size rewrite that keeps the mtime must not be served from the cache
+        racy_path = os.path.join(root, "racy.txt")
+        with open(racy_path, "wb") as f:
+            f.write(b"first version")
+        mtime_ns = os.stat(racy_path).st_mtime_ns
+        hash_tree(root, cache_path)
+
+        with open(racy_path, "wb") as f:
+            f.write(b"other version")
+        os.utime(racy_path, ns=(mtime_ns, mtime_ns))
+
+        if hash_tree(root, cache_path) == hash_tree(root):
+            print("✅ Racy rewrite: Passed")
+        else:
+            print("❌ Racy rewrite: Failed")
+
+        # A damaged cache file is rebuilt instead of failing every run
+        with open(cache_path, "wb") as f:
+            f.write(b"not a cache")
+
+        if hash_tree(root, cache_path) == hash_tree(root):
+            with open(cache_path, "rb") as f:
+                rebuilt = f.read(4) == b"EHDC"
+        else:
+            rebuilt = False
+
+        if rebuilt:
+            print("✅ Damaged cache: Passed")
+        else:
+            print("❌ Damaged cache: Failed")
+
+        # A missing root must not hash as an empty tree
+        try:
+            hash_tree(os.path.join(tmp_dir, "missing"))
+            print("❌ Missing root: Failed")
+        except FileNotFoundError:
+            print("✅ Missing root: Passed")
+
+
 if __name__ == "__main__":
 
     print("\n   Start Tests ..")
@@ -258,4 +396,6 @@ if __name__ == "__main__":
     test_avalanche_effect()
     test_scalability()
     test_collision_resistance()
+    test_merkle_index()
+    test_tree_hashing()
  